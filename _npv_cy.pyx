@@ -0,0 +1,19 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Kernel NPV compilato con Cython, usato quando numba non è installato
+
+Compilazione: cythonize -i _npv_cy.pyx
+"""
+
+
+def npv_cy(const double[:] cf, double r):
+    """
+    Somma dei flussi scontati con un fattore di sconto progressivo
+    """
+    cdef Py_ssize_t i, n = cf.shape[0]
+    cdef double inv = 1.0 / (1.0 + r)
+    cdef double disc = 1.0, acc = 0.0
+    for i in range(n):
+        disc *= inv
+        acc += cf[i] * disc
+    return acc
@@ -1,72 +1,46 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import plotly.express as px
 from apv_calculator import APVCalculator
 
-def main():
-    st.title("Calcolatore APV (Adjusted Present Value)")
-    
-    calculator = APVCalculator()
-    
-    # Inizializza session_state se non esiste
-    if 'financial_data' not in st.session_state:
-        st.session_state.financial_data = None
-    
-    # Aggiunta input per il ticker
-    ticker = st.sidebar.text_input("Simbolo Azione (es. AAPL)", value="AAPL")
-    
-    if st.sidebar.button("Carica Dati"):
-        try:
-            with st.spinner("Caricamento dati finanziari..."):
-                st.session_state.financial_data = calculator.get_financial_data(ticker)
-                st.success(f"Dati caricati con successo per {ticker}")
-                
-                # Mostra i dati finanziari principali
-                st.subheader("Dati Finanziari Principali")
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    st.metric("Debito Totale", 
-                             f"${st.session_state.financial_data['total_debt']:,.2f}")
-                    st.metric("Aliquota Fiscale Effettiva", 
-                             f"{st.session_state.financial_data['effective_tax_rate']*100:.2f}%")
-                
-                with col2:
-                    st.metric("Flusso di Cassa Operativo (Ultimo Anno)", 
-                             f"${st.session_state.financial_data['operating_cashflow'][0]:,.2f}")
-        except Exception as e:
-            st.error(f"Errore nel caricamento dei dati: {str(e)}")
-    
-    # Sidebar per input
-    st.sidebar.header("Parametri di Input")
-    
-    # Input per i flussi di cassa
-    st.sidebar.subheader("Flussi di Cassa")
-    if st.session_state.financial_data is not None:
-        cash_flows = st.session_state.financial_data['operating_cashflow'][:5]  # Ultimi 5 anni
-        num_years = len(cash_flows)
-    else:
-        num_years = st.sidebar.number_input("Numero di anni", min_value=1, max_value=10, value=5)
-        cash_flows = []
-        for i in range(num_years):
-            cf = st.sidebar.number_input(f"Flusso di cassa anno {i+1}", value=1000.0)
-            cash_flows.append(cf)
-    
-    # Altri parametri
-    if st.session_state.financial_data is not None:
-        tax_rate = st.sidebar.number_input("Aliquota fiscale (%)", 
-                                         value=float(st.session_state.financial_data['effective_tax_rate']*100),
-                                         min_value=0.0, max_value=100.0) / 100
-        debt = st.session_state.financial_data['total_debt']
-    else:
-        tax_rate = st.sidebar.number_input("Aliquota fiscale (%)", 
-                                         value=25.0, min_value=0.0, max_value=100.0) / 100
-        debt = st.sidebar.number_input("Debito", min_value=0.0, value=1000.0)
+@st.cache_resource
+def get_calculator() -> APVCalculator:
+    """
+    Restituisce un'unica istanza del calcolatore condivisa tra i rerun
+    """
+    return APVCalculator()
+
+@st.cache_data
+def _sensitivity_fig(variations: tuple, values: tuple):
+    """
+    Costruisce il grafico di sensibilità, in cache per gli stessi valori
+    """
+    import plotly.express as px  # import pesante, caricato solo quando serve
     
-    discount_rate = st.sidebar.number_input("Tasso di sconto (%)", 
-                                          min_value=0.0, max_value=100.0, value=10.0) / 100
-    cost_of_debt = st.sidebar.number_input("Costo del debito (%)", 
-                                         min_value=0.0, max_value=100.0, value=5.0) / 100
+    df_sensitivity = pd.DataFrame({
+        'Variazione': [f"{v*100}%" for v in variations],
+        'APV': list(values)
+    })
+    return px.line(df_sensitivity, x='Variazione', y='APV', 
+                   title='Analisi di Sensibilità APV')
+
+@st.fragment
+def _results_panel(calculator: APVCalculator, cash_flows, tax_rate: float, debt: float):
+    """
+    Sezione di calcolo e visualizzazione dei risultati
+    
+    È un frammento Streamlit: modificare tasso di sconto o costo del debito
+    riesegue solo questa sezione, non il caricamento dati né i prospetti storici.
+    """
+    # Parametri di tasso (fuori dalla sidebar, che non è accessibile da un frammento)
+    st.header("Parametri di Sconto")
+    col1, col2 = st.columns(2)
+    with col1:
+        discount_rate = st.number_input("Tasso di sconto (%)", 
+                                        min_value=0.0, max_value=100.0, value=10.0) / 100
+    with col2:
+        cost_of_debt = st.number_input("Costo del debito (%)", 
+                                       min_value=0.0, max_value=100.0, value=5.0) / 100
     
     # Calcoli
     npv = calculator.calculate_npv(cash_flows, discount_rate)
@@ -82,7 +56,9 @@ def main():
         'Anno': [f'Anno {i+1}' for i in range(len(cash_flows))],
         'Flusso di Cassa ($)': cash_flows
     })
-    st.dataframe(df_cashflows.style.format({'Flusso di Cassa ($)': '${:,.2f}'}))
+    # La formattazione avviene nel browser, senza generare HTML con pandas Styler
+    st.dataframe(df_cashflows, hide_index=True,
+                 column_config={'Flusso di Cassa ($)': st.column_config.NumberColumn(format="dollar")})
     
     # Mostra i parametri utilizzati
     st.subheader("Parametri Utilizzati")
@@ -137,6 +113,106 @@ def main():
         st.write("\n**Formula APV:**")
         st.latex(r"APV = NPV + TS")
     
+    # Analisi di sensibilità
+    st.header("Analisi di Sensibilità")
+    variations = [-0.2, -0.1, 0, 0.1, 0.2]
+    sensitivity = calculator.sensitivity_analysis(apv, variations)
+    
+    if len(sensitivity['values']) <= 20:
+        # Pochi punti: il grafico Vega-Lite nativo è più leggero di una figura Plotly.
+        # L'asse numerico mantiene l'ordine delle variazioni
+        df_sensitivity = pd.DataFrame(
+            {'APV': sensitivity['values']},
+            index=pd.Index(np.asarray(sensitivity['variations']) * 100, name='Variazione (%)')
+        )
+        st.line_chart(df_sensitivity)
+    else:
+        fig = _sensitivity_fig(tuple(sensitivity['variations']), tuple(sensitivity['values']))
+        st.plotly_chart(fig)
+    
+    # Il toggle evita di calcolare la griglia (e importare plotly) se non richiesta,
+    # a differenza di un expander il cui contenuto viene eseguito comunque
+    if st.toggle("Heatmap sensibilità"):
+        # Griglia attorno ai parametri correnti: ±5 punti sul tasso, ±10 sull'aliquota
+        rates = np.linspace(max(discount_rate - 0.05, 0.0), discount_rate + 0.05, 41)
+        taxes = np.linspace(max(tax_rate - 0.10, 0.0), min(tax_rate + 0.10, 1.0), 41)
+        grid = calculator.sensitivity_grid(cash_flows, rates, taxes, debt, cost_of_debt)
+        
+        import plotly.express as px  # import pesante, caricato solo quando serve
+        fig_grid = px.imshow(grid, x=taxes * 100, y=rates * 100, aspect='auto', origin='lower',
+                             labels={'x': 'Aliquota Fiscale (%)', 'y': 'Tasso di Sconto (%)',
+                                     'color': 'APV ($)'},
+                             title='APV per Tasso di Sconto e Aliquota Fiscale')
+        st.plotly_chart(fig_grid)
+
+def main():
+    st.title("Calcolatore APV (Adjusted Present Value)")
+    
+    calculator = get_calculator()
+    
+    # Inizializza session_state se non esiste
+    if 'financial_data' not in st.session_state:
+        st.session_state.financial_data = None
+    
+    # Aggiunta input per il ticker
+    ticker = st.sidebar.text_input("Simbolo Azione (es. AAPL)", value="AAPL")
+    
+    if st.sidebar.button("Carica Dati"):
+        try:
+            # Lo spinner è mostrato dalla funzione in cache, solo se scarica i dati
+            st.session_state.financial_data = calculator.get_financial_data(ticker)
+            if st.session_state.financial_data['refresh_error']:
+                st.warning(f"Aggiornamento dei dati non riuscito: vengono usati quelli del "
+                           f"{st.session_state.financial_data['as_of']} "
+                           f"({st.session_state.financial_data['refresh_error']})")
+            else:
+                st.success(f"Dati caricati con successo per {ticker}")
+            
+            # Mostra i dati finanziari principali
+            st.subheader("Dati Finanziari Principali")
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                st.metric("Debito Totale", 
+                         f"${st.session_state.financial_data['total_debt']:,.2f}")
+                st.metric("Aliquota Fiscale Effettiva", 
+                         f"{st.session_state.financial_data['effective_tax_rate']*100:.2f}%")
+            
+            with col2:
+                st.metric("Flusso di Cassa Operativo (Ultimo Anno)", 
+                         f"${st.session_state.financial_data['operating_cashflow'][0]:,.2f}")
+        except Exception as e:
+            st.error(f"Errore nel caricamento dei dati: {str(e)}")
+    
+    # Sidebar per input
+    st.sidebar.header("Parametri di Input")
+    
+    # Input per i flussi di cassa
+    st.sidebar.subheader("Flussi di Cassa")
+    if st.session_state.financial_data is not None:
+        cash_flows = st.session_state.financial_data['operating_cashflow'][:5]  # Ultimi 5 anni
+        num_years = len(cash_flows)
+    else:
+        num_years = st.sidebar.number_input("Numero di anni", min_value=1, max_value=10, value=5)
+        cash_flows = []
+        for i in range(num_years):
+            cf = st.sidebar.number_input(f"Flusso di cassa anno {i+1}", value=1000.0)
+            cash_flows.append(cf)
+    
+    # Altri parametri
+    if st.session_state.financial_data is not None:
+        tax_rate = st.sidebar.number_input("Aliquota fiscale (%)", 
+                                         value=float(st.session_state.financial_data['effective_tax_rate']*100),
+                                         min_value=0.0, max_value=100.0) / 100
+        debt = st.session_state.financial_data['total_debt']
+    else:
+        tax_rate = st.sidebar.number_input("Aliquota fiscale (%)", 
+                                         value=25.0, min_value=0.0, max_value=100.0) / 100
+        debt = st.sidebar.number_input("Debito", min_value=0.0, value=1000.0)
+    
+    # Calcoli, risultati e sensibilità (frammento rieseguito in modo indipendente)
+    _results_panel(calculator, cash_flows, tax_rate, debt)
+    
     # Mostra i dati di input
     if st.session_state.financial_data is not None:
         st.subheader("Dati Finanziari Utilizzati")
@@ -146,34 +222,30 @@ def main():
                     f"{st.session_state.financial_data['effective_tax_rate']*100:.2f}%")
             st.write("\n**Flussi di Cassa Operativi:**")
             st.dataframe(pd.DataFrame(st.session_state.financial_data['operating_cashflow'], 
-                                    columns=['Valore ($)']).style.format({'Valore ($)': '${:,.2f}'}))
-    
-    # Analisi di sensibilità
-    st.header("Analisi di Sensibilità")
-    variations = [-0.2, -0.1, 0, 0.1, 0.2]
-    sensitivity = calculator.sensitivity_analysis(apv, variations)
-    
-    df_sensitivity = pd.DataFrame({
-        'Variazione': [f"{v*100}%" for v in sensitivity['variations']],
-        'APV': sensitivity['values']
-    })
-    
-    fig = px.line(df_sensitivity, x='Variazione', y='APV', 
-                  title='Analisi di Sensibilità APV')
-    st.plotly_chart(fig)
+                                    columns=['Valore ($)']),
+                         column_config={'Valore ($)': st.column_config.NumberColumn(format="dollar")})
     
     # Mostra i dati storici se disponibili
     if st.session_state.financial_data is not None:
         st.header("Dati Storici")
         
-        tab1, tab2, tab3 = st.tabs(["Flussi di Cassa", "Bilancio", "Conto Economico"])
+        # I prospetti completi non sono in session_state: vengono letti dalla cache,
+        # che può essere scaduta e richiedere un nuovo download
+        try:
+            statements = calculator.get_financial_statements(st.session_state.financial_data['ticker'])
+        except Exception as e:
+            statements = None
+            st.error(f"Errore nel caricamento dei dati storici: {str(e)}")
         
-        with tab1:
-            st.dataframe(st.session_state.financial_data['cashflow'])
-        with tab2:
-            st.dataframe(st.session_state.financial_data['balance_sheet'])
-        with tab3:
-            st.dataframe(st.session_state.financial_data['income_stmt'])
+        if statements is not None:
+            tab1, tab2, tab3 = st.tabs(["Flussi di Cassa", "Bilancio", "Conto Economico"])
+            
+            with tab1:
+                st.dataframe(statements['cashflow'])
+            with tab2:
+                st.dataframe(statements['balance_sheet'])
+            with tab3:
+                st.dataframe(statements['income_stmt'])
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
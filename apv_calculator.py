@@ -1,37 +1,308 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
-import yfinance as yf
-from typing import List, Dict, Union
+import streamlit as st
+from typing import List, Dict, Tuple, Union
+
+try:
+    from numba import float64, guvectorize, njit
+    HAS_NUMBA = True
+except ImportError:  # numba è opzionale: senza di esso si usa il percorso NumPy
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """
+        Sostituto no-op di numba.njit quando numba non è installato
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    from _npv_cy import npv_cy
+except ImportError:  # estensione Cython non compilata: si usa il percorso NumPy
+    npv_cy = None
+
+
+@njit(cache=True, fastmath=True)
+def _npv_kernel(cf: np.ndarray, r: float) -> float:
+    """
+    Somma dei flussi scontati con un fattore di sconto progressivo
+
+    Il fattore 1 / (1 + r)^t viene aggiornato con una moltiplicazione per
+    periodo, evitando sia la potenza sia la divisione a ogni iterazione.
+    """
+    inv = 1.0 / (1.0 + r)
+    disc = 1.0
+    acc = 0.0
+    for i in range(cf.shape[0]):
+        disc *= inv
+        acc += cf[i] * disc
+    return acc
+
+
+@njit(cache=True)
+def _tax_shield_kernel(debt: float, tax_rate: float, cost_of_debt: float) -> float:
+    """
+    Versione compilata di APVCalculator.calculate_tax_shield per i kernel di scenario
+    """
+    if cost_of_debt == 0.0:  # Evita la divisione per zero
+        return debt * tax_rate
+    return debt * tax_rate * cost_of_debt / (1.0 + cost_of_debt)
+
+
+@njit(cache=True)
+def _apv_kernel(cf: np.ndarray, r: float, tau: float, debt: float, rd: float) -> float:
+    """
+    APV di un singolo scenario: NPV dei flussi più beneficio fiscale del debito
+    """
+    return _npv_kernel(cf, r) + _tax_shield_kernel(debt, tau, rd)
+
+
+@njit(cache=True)
+def _apv_grid(cf: np.ndarray, rates: np.ndarray, taxes: np.ndarray,
+              debt: float, rd: float) -> np.ndarray:
+    """
+    Matrice APV tassi × aliquote
+
+    Il ciclo è seriale: parallel=True non è sicuro quando più thread di script
+    di Streamlit chiamano il kernel, e griglie di queste dimensioni non ne
+    trarrebbero vantaggio.
+    """
+    out = np.empty((rates.size, taxes.size))
+    for i in range(rates.size):
+        for j in range(taxes.size):
+            out[i, j] = _apv_kernel(cf, rates[i], taxes[j], debt, rd)
+    return out
+
+
+@lru_cache(maxsize=None)
+def _apv_gufunc():
+    """
+    Restituisce il kernel APV vettorizzato, costruendolo alla prima chiamata
+
+    Con numba è una gufunc con layout '(n),(),(),(),()->()': riceve un vettore
+    di flussi più i quattro parametri scalari e NumPy ne fa il broadcasting.
+    La compilazione è rimandata al primo uso per non rallentare l'import del
+    modulo, che l'app esegue a ogni avvio.
+    """
+    if not HAS_NUMBA:
+        return _apv_numpy
+
+    @guvectorize([(float64[:], float64, float64, float64, float64, float64[:])],
+                 '(n),(),(),(),()->()', nopython=True, cache=True)
+    def apv_gufunc(cf, r, tau, debt, rd, out):
+        out[0] = _apv_kernel(cf, r, tau, debt, rd)
+
+    return apv_gufunc
+
+
+def _apv_numpy(cf, r, tau, debt, rd):
+    """
+    Equivalente NumPy della gufunc APV quando numba non è installato
+    """
+    r, tau, debt, rd = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64)
+                                             for x in (r, tau, debt, rd)))
+    periods = np.arange(1, cf.shape[0] + 1, dtype=np.float64)
+    npv = (cf / (1.0 + r[..., None]) ** periods).sum(axis=-1)
+    with np.errstate(divide='ignore'):
+        shield = np.where(rd == 0.0, debt * tau, debt * tau * rd / (1.0 + rd))
+    return npv + shield
+
+
+@lru_cache(maxsize=256)
+def _disc_vec(r: float, n: int) -> np.ndarray:
+    """
+    Vettore dei fattori di sconto 1 / (1 + r)^t per t = 1..n, in cache per (r, n)
+    """
+    vec = 1.0 / (1.0 + r) ** np.arange(1, n + 1, dtype=np.float64)
+    vec.flags.writeable = False  # condiviso tra le chiamate: non deve essere modificato
+    return vec
+
+
+def _clean_cash_flows(cash_flows: Union[List[float], np.ndarray]) -> np.ndarray:
+    """
+    Converte i flussi di cassa in un array float64 positivo senza None o nan
+    """
+    cf = np.asarray(cash_flows)
+    if cf.dtype.kind in 'biuf':
+        cf = cf.astype(np.float64, copy=False)
+    else:
+        # None, stringhe o valori misti: pd.to_numeric li converte in un solo
+        # passaggio, trasformando i valori non numerici in nan
+        cf = pd.to_numeric(pd.Series(cf.ravel(), dtype=object), errors='coerce').to_numpy(np.float64)
+    cf = cf[np.isfinite(cf)]  # l'indicizzazione booleana crea una copia
+    np.abs(cf, out=cf)
+    return cf
+
+
+def _download_statements(ticker: str) -> Dict[str, Union[pd.DataFrame, str]]:
+    """
+    Scarica da Yahoo Finance bilancio, conto economico e rendiconto finanziario
+    
+    Non usa cache: ogni chiamata crea un nuovo yf.Ticker, perché yfinance
+    memorizza sull'oggetto i prospetti letti, anche quelli vuoti.
+    """
+    # yfinance viene importato qui e non a livello di modulo: è un import pesante
+    # che rallenterebbe la prima esecuzione dello script
+    import yfinance as yf
+    stock = yf.Ticker(ticker)
+    statements = {
+        'balance_sheet': stock.balance_sheet,
+        'income_stmt': stock.financials,
+        'cashflow': stock.cashflow
+    }
+    
+    # Quando Yahoo limita le richieste, yfinance restituisce spesso DataFrame vuoti
+    # invece di sollevare un errore: l'eccezione evita che finiscano nella cache
+    empty = [name for name, df in statements.items() if df.empty]
+    if empty:
+        raise ValueError(f"Yahoo Finance ha restituito prospetti vuoti per {ticker}: {', '.join(empty)}")
+    
+    statements['as_of'] = date.today().isoformat()
+    return statements
+
+
+# Prospetti appena riscaricati da _refresh_statements, in attesa di entrare in cache
+_refreshed_statements: Dict[str, Dict[str, Union[pd.DataFrame, str]]] = {}
+
+
+@st.cache_data(persist="disk", max_entries=64, show_spinner="Caricamento dati finanziari...")
+def _fetch_statements(ticker: str) -> Dict[str, Union[pd.DataFrame, str]]:
+    """
+    Prospetti contabili di un ticker, in cache su disco
+    
+    La cache sopravvive ai riavvii dell'app. Streamlit ignora il ttl delle
+    cache persistenti e non cancella dal disco le voci scartate da max_entries:
+    la chiave è quindi solo il ticker (un file per simbolo) e la data del
+    download è salvata in 'as_of', così _fetch_financials può rinnovare i dati
+    una volta al giorno.
+    """
+    refreshed = _refreshed_statements.pop(ticker, None)
+    if refreshed is not None:
+        return refreshed
+    return _download_statements(ticker)
+
+
+def _refresh_statements(ticker: str, stale: Dict[str, Union[pd.DataFrame, str]]):
+    """
+    Rinnova i prospetti in cache di un ticker, senza perderli se il download fallisce
+    
+    Restituisce la coppia (prospetti, errore): se il download riesce, i nuovi
+    prospetti sostituiscono la voce in cache ed errore è None; altrimenti la
+    voce resta invariata e vengono restituiti i prospetti precedenti con il
+    messaggio di errore.
+    """
+    try:
+        fresh = _download_statements(ticker)
+    except Exception as e:
+        return stale, str(e)
+    
+    # La voce viene cancellata solo ora che i nuovi dati sono disponibili: il
+    # ricalcolo di _fetch_statements li prende da _refreshed_statements senza
+    # una seconda richiesta di rete
+    _refreshed_statements[ticker] = fresh
+    _fetch_statements.clear(ticker)
+    return _fetch_statements(ticker), None
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_financials(ticker: str) -> Dict[str, Union[np.ndarray, float, str]]:
+    """
+    Estrae dai prospetti contabili solo i valori usati nel calcolo dell'APV
+    
+    Il risultato è leggero e può essere tenuto in st.session_state; i prospetti
+    completi restano nella cache di _fetch_statements. Se i prospetti in cache
+    sono di un giorno precedente e il rinnovo fallisce, vengono usati quelli
+    ('as_of' indica la data) e 'refresh_error' riporta il motivo; come ogni
+    risultato, anche questo resta in cache per un'ora prima di un nuovo tentativo.
+    """
+    try:
+        statements = _fetch_statements(ticker)
+        refresh_error = None
+        if statements['as_of'] != date.today().isoformat():
+            # Prospetti di un giorno precedente: vengono riscaricati solo qui, su
+            # richiesta esplicita, e mai durante un normale rerun dell'app
+            statements, refresh_error = _refresh_statements(ticker, statements)
+        
+        # Ottieni il bilancio e il conto economico
+        balance_sheet = statements['balance_sheet']
+        income_stmt = statements['income_stmt']
+        cashflow = statements['cashflow']
+        
+        # Calcola i flussi di cassa operativi (ultimi 4 anni)
+        if 'Operating Cash Flow' in cashflow.index:
+            operating_cashflow = cashflow.loc['Operating Cash Flow'].values
+        elif 'Total Cash From Operating Activities' in cashflow.index:
+            operating_cashflow = cashflow.loc['Total Cash From Operating Activities'].values
+        else:
+            operating_cashflow = np.zeros(4)  # Default a zero se non trovato
+        
+        # Ottieni il debito totale dall'ultimo anno
+        # (.at legge il singolo valore senza costruire la Series della riga)
+        idx = balance_sheet.index
+        total_debt = 0
+        for label in ('Total Debt', 'Long Term Debt', 'Total Long Term Debt'):
+            if label in idx:
+                total_debt = float(balance_sheet.at[label, balance_sheet.columns[0]])
+                break
+        
+        # Calcola l'aliquota fiscale effettiva dall'ultimo anno
+        idx = income_stmt.index
+        if 'Income Tax Expense' in idx and 'Pretax Income' in idx:
+            last_year = income_stmt.columns[0]
+            tax_expense = float(income_stmt.at['Income Tax Expense', last_year])
+            pretax_income = float(income_stmt.at['Pretax Income', last_year])
+            effective_tax_rate = tax_expense / pretax_income if pretax_income != 0 else 0.25
+        else:
+            effective_tax_rate = 0.25  # Valore di default
+        
+        return {
+            'ticker': ticker,
+            'operating_cashflow': np.asarray(operating_cashflow, dtype=np.float64),
+            'total_debt': total_debt,
+            'effective_tax_rate': effective_tax_rate,
+            'as_of': statements['as_of'],
+            'refresh_error': refresh_error
+        }
+        
+    except Exception as e:
+        print(f"Dettaglio errore: {e}")  # Per debug
+        raise Exception(f"Errore nel recupero dei dati per {ticker}: {str(e)}")
+
 
 class APVCalculator:
     def __init__(self):
         self.results = {}
     
-    def calculate_npv(self, cash_flows: List[float], discount_rate: float) -> float:
+    def calculate_npv(self, cash_flows: Union[List[float], np.ndarray], discount_rate: float) -> float:
         """
         Calcola il Valore Attuale Netto dei flussi di cassa
         
         Args:
-            cash_flows: Lista dei flussi di cassa futuri
+            cash_flows: Flussi di cassa futuri (lista o array float64)
             discount_rate: Tasso di sconto (es. 0.10 per 10%)
         """
         # Converti i cash flows in numeri positivi e rimuovi eventuali None o nan
-        clean_cash_flows = []
-        for cf in cash_flows:
-            if cf is not None and not pd.isna(cf):
-                clean_cash_flows.append(abs(float(cf)))
-        
+        cf = _clean_cash_flows(cash_flows)
+
         # Verifica che ci siano flussi di cassa validi
-        if not clean_cash_flows:
+        if cf.size == 0:
             return 0.0
-        
-        npv = 0.0
-        for t, cf in enumerate(clean_cash_flows):
-            npv += cf / ((1 + discount_rate) ** (t + 1))
-        
-        return npv
+
+        if HAS_NUMBA:
+            return float(_npv_kernel(cf, float(discount_rate)))
+        if npv_cy is not None:
+            return float(npv_cy(cf, float(discount_rate)))
+
+        # Prodotto scalare con il vettore di sconto, riusato tra chiamate con lo stesso tasso
+        return float(cf @ _disc_vec(float(discount_rate), cf.size))
     
-    def calculate_tax_shield(self, debt: float, tax_rate: float, cost_of_debt: float) -> float:
+    @staticmethod
+    def calculate_tax_shield(debt: float, tax_rate: float, cost_of_debt: float) -> float:
         """
         Calcola il valore attuale dei benefici fiscali del debito
         
@@ -44,10 +315,14 @@ class APVCalculator:
         if debt is None or tax_rate is None or cost_of_debt is None:
             return 0.0
         
-        if cost_of_debt == 0:  # Evita la divisione per zero
-            return debt * tax_rate
+        d = float(debt)
+        t = float(tax_rate)
+        rd = float(cost_of_debt)
+        if rd == 0.0:  # Evita la divisione per zero
+            return d * t
         
-        return float(debt) * float(tax_rate) * (1 - 1/(1 + float(cost_of_debt)))
+        # Equivale a D * τ * (1 - 1/(1 + r_d)) con un'operazione in meno
+        return d * t * rd / (1.0 + rd)
     
     def calculate_apv(self, npv: float, tax_shield: float) -> float:
         """
@@ -56,65 +331,121 @@ class APVCalculator:
         return npv + tax_shield
     
     def sensitivity_analysis(self, base_value: float, 
-                           variations: List[float]) -> Dict[str, List[float]]:
+                           variations: Union[List[float], List[List[float]], np.ndarray]) -> Dict[str, list]:
         """
         Esegue l'analisi di sensibilità sul valore base
         
         Args:
             base_value: Valore base per l'analisi
-            variations: Lista delle variazioni percentuali (es. [-0.1, 0, 0.1])
+            variations: Variazioni percentuali (es. [-0.1, 0, 0.1]); accetta anche
+                una griglia 2-D (es. variazioni del tasso di sconto × aliquota fiscale),
+                nel qual caso 'values' è una matrice con la stessa forma
         """
+        v = np.asarray(variations, dtype=np.float64)
         results = {
             'variations': variations,
-            'values': [base_value * (1 + v) for v in variations]
+            'values': (base_value * (1.0 + v)).tolist()
         }
         return results
     
-    def get_financial_data(self, ticker: str) -> Dict[str, Union[pd.DataFrame, float]]:
-        """
-        Recupera i dati finanziari dettagliati usando Yahoo Finance
-        """
-        try:
-            stock = yf.Ticker(ticker)
-            
-            # Ottieni il bilancio e il conto economico
-            balance_sheet = stock.balance_sheet
-            income_stmt = stock.financials
-            cashflow = stock.cashflow
-            
-            # Calcola i flussi di cassa operativi (ultimi 4 anni)
-            if 'Operating Cash Flow' in cashflow.index:
-                operating_cashflow = cashflow.loc['Operating Cash Flow'].values
-            elif 'Total Cash From Operating Activities' in cashflow.index:
-                operating_cashflow = cashflow.loc['Total Cash From Operating Activities'].values
-            else:
-                operating_cashflow = np.zeros(4)  # Default a zero se non trovato
-            
-            # Ottieni il debito totale dall'ultimo anno
-            debt_labels = ['Total Debt', 'Long Term Debt', 'Total Long Term Debt']
-            total_debt = 0
-            for label in debt_labels:
-                if label in balance_sheet.index:
-                    total_debt = float(balance_sheet.loc[label].iloc[0])
-                    break
-            
-            # Calcola l'aliquota fiscale effettiva dall'ultimo anno
-            if 'Income Tax Expense' in income_stmt.index and 'Pretax Income' in income_stmt.index:
-                tax_expense = float(income_stmt.loc['Income Tax Expense'].iloc[0])
-                pretax_income = float(income_stmt.loc['Pretax Income'].iloc[0])
-                effective_tax_rate = tax_expense / pretax_income if pretax_income != 0 else 0.25
-            else:
-                effective_tax_rate = 0.25  # Valore di default
-            
-            return {
-                'operating_cashflow': operating_cashflow.tolist(),
-                'total_debt': total_debt,
-                'effective_tax_rate': effective_tax_rate,
-                'balance_sheet': balance_sheet,
-                'income_stmt': income_stmt,
-                'cashflow': cashflow
-            }
-            
-        except Exception as e:
-            print(f"Dettaglio errore: {e}")  # Per debug
-            raise Exception(f"Errore nel recupero dei dati per {ticker}: {str(e)}") 
\ No newline at end of file
+    def scenario_analysis(self, cash_flows: Union[List[float], np.ndarray],
+                          discount_rates, tax_rates, debts, costs_of_debt) -> np.ndarray:
+        """
+        Calcola l'APV su una griglia di scenari in un'unica chiamata vettoriale
+        
+        I parametri possono essere scalari o array e vengono combinati con le
+        regole di broadcasting di NumPy, ad es. tassi[:, None] e aliquote[None, :]
+        producono una matrice tassi × aliquote.
+        
+        Args:
+            cash_flows: Flussi di cassa futuri
+            discount_rates: Tassi di sconto (es. 0.10 per 10%)
+            tax_rates: Aliquote fiscali (es. 0.25 per 25%)
+            debts: Valori del debito
+            costs_of_debt: Costi del debito (es. 0.05 per 5%)
+        """
+        cf = _clean_cash_flows(cash_flows)
+        return np.asarray(_apv_gufunc()(cf, discount_rates, tax_rates, debts, costs_of_debt),
+                          dtype=np.float64)
+    
+    def sensitivity_grid(self, cash_flows: Union[List[float], np.ndarray],
+                         discount_rates: Union[List[float], np.ndarray],
+                         tax_rates: Union[List[float], np.ndarray],
+                         debt: float, cost_of_debt: float) -> np.ndarray:
+        """
+        Calcola la matrice APV per ogni coppia (tasso di sconto, aliquota fiscale)
+        
+        Args:
+            cash_flows: Flussi di cassa futuri
+            discount_rates: Tassi di sconto delle righe (es. 0.10 per 10%)
+            tax_rates: Aliquote fiscali delle colonne (es. 0.25 per 25%)
+            debt: Valore del debito
+            cost_of_debt: Costo del debito (es. 0.05 per 5%)
+        """
+        cf = _clean_cash_flows(cash_flows)
+        rates = np.asarray(discount_rates, dtype=np.float64)
+        taxes = np.asarray(tax_rates, dtype=np.float64)
+        
+        if HAS_NUMBA:
+            return _apv_grid(cf, rates, taxes, float(debt), float(cost_of_debt))
+        
+        # Senza numba il ciclo Python sarebbe lento: si usa il broadcasting NumPy
+        return _apv_numpy(cf, rates[:, None], taxes[None, :], debt, cost_of_debt)
+    
+    def get_financial_data(self, ticker: str) -> Dict[str, Union[np.ndarray, float, str]]:
+        """
+        Recupera i dati finanziari usati nel calcolo usando Yahoo Finance
+        
+        Restituisce solo flussi di cassa operativi, debito totale e aliquota
+        effettiva; i prospetti completi si ottengono con get_financial_statements.
+        """
+        # 'aapl' e 'AAPL' condividono la stessa voce di cache
+        return _fetch_financials(ticker.strip().upper())
+    
+    def get_financial_statements(self, ticker: str) -> Dict[str, Union[pd.DataFrame, str]]:
+        """
+        Recupera i prospetti contabili completi (bilancio, conto economico, cash flow)
+        
+        Restituisce i prospetti in cache anche se scaricati in un giorno precedente
+        ('as_of'); il rinnovo avviene con get_financial_data.
+        """
+        return _fetch_statements(ticker.strip().upper())
+    
+    def get_financial_data_batch(self, tickers: List[str]) -> Tuple[Dict[str, Dict[str, Union[np.ndarray, float, str]]],
+                                                                    Dict[str, Exception]]:
+        """
+        Recupera in parallelo i dati finanziari di più ticker
+        
+        Ogni ticker passa dalla cache di get_financial_data, quindi solo i
+        simboli non ancora in cache generano richieste di rete. I simboli sono
+        normalizzati in maiuscolo e deduplicati: le chiavi del risultato sono
+        quelle normalizzate.
+        
+        Un simbolo che fallisce (es. inesistente o delistato) non interrompe gli
+        altri: restituisce la coppia (dati, errori), dove 'dati' contiene i ticker
+        caricati con successo ed 'errori' l'eccezione sollevata per ciascuno degli
+        altri. Ogni simbolo compare in esattamente uno dei due dizionari.
+        
+        Args:
+            tickers: Lista dei simboli azionari (es. ['AAPL', 'MSFT'])
+        """
+        # dict.fromkeys conserva l'ordine e scarta i duplicati (es. 'aapl' e 'AAPL')
+        symbols = list(dict.fromkeys(ticker.strip().upper() for ticker in tickers))
+        results = {}
+        errors = {}
+        if not symbols:
+            return results, errors
+        
+        with ThreadPoolExecutor(max_workers=min(16, len(symbols))) as executor:
+            futures = {executor.submit(self.get_financial_data, symbol): symbol for symbol in symbols}
+            for future in as_completed(futures):
+                symbol = futures[future]
+                error = future.exception()
+                if error is not None:
+                    errors[symbol] = error
+                else:
+                    results[symbol] = future.result()
+        
+        # Stesso ordine dei ticker richiesti, indipendentemente dall'ordine di completamento
+        return ({s: results[s] for s in symbols if s in results},
+                {s: errors[s] for s in symbols if s in errors})